@@ -1,14 +1,36 @@
+import atexit
+import hashlib
 import json
 import os
+import threading
+import time
 import uuid
-from dataclasses import dataclass, asdict
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from typing import List
 import flet as ft
 import g4f
 
+from response_cache import ResponseCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # --- Config ---
-DATA_FILE = "conversations.json"
+DATA_FILE = "conversations.jsonl"
+LEGACY_DATA_FILE = "conversations.json"  # pre-JSONL format, read once for migration
 DEFAULT_MODEL = "gpt-4o-mini"
+FALLBACK_MODELS = ["gpt-4o-mini", "gpt-3.5-turbo", "gpt-4", "gemini-pro", "claude-3-haiku"]
+MODELS_CACHE_FILE = os.path.expanduser("~/.cache/chatgpt-clone/models.json")
+MODELS_CACHE_TTL = 24 * 3600  # seconds before the cached model list is refreshed
+MAX_CONTEXT_MESSAGES = 40  # most recent messages sent to the model per turn
+STREAM_FLUSH_INTERVAL = 0.033  # seconds between UI refreshes while streaming (~30fps)
+SAVE_DEBOUNCE_SECONDS = 2.0  # coalesce disk writes during bursts of messages
+CONVO_CACHE_SIZE = 4  # conversations kept fully loaded in memory at once
+VISIBLE_MESSAGES = 60  # bubbles rendered per window; older ones load on scroll-up
 
 # --- Data models ---
 @dataclass
@@ -21,49 +43,400 @@ class Conversation:
     id: str
     title: str
     messages: List[Message]
+    loaded: bool = False  # False: messages live on disk only (see ConversationCache)
+    # Ready-to-send g4f payload, kept in sync with `messages` so each send
+    # (and the streaming fallback) reuses it instead of rebuilding O(N) dicts.
+    _api_messages: List[dict] = field(default_factory=list, repr=False)
+
+    def sync_api_messages(self):
+        self._api_messages = [{"role": m.role, "content": m.content} for m in self.messages]
 
 
 # --- Storage helpers ---
+# On-disk format is append-only JSONL: one record per line. A record with a
+# "title" key (re)titles a conversation, one with a "role" key is a message.
+# New messages cost one appended line instead of rewriting the whole history;
+# a full snapshot is only written on new chats and title changes.
+def _dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def _loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# Startup only builds a lightweight index (id, title, message count, byte
+# offset of the convo's first record); messages are materialized on demand
+# by ConversationCache so startup cost is independent of history size.
+_convo_index = {}  # convo_id -> {"offset": int, "count": int}
+
+# Serializes file access and index updates across threads: the debounce
+# timer rewrites the file while the generation worker appends to it.
+# Reentrant because save_conversations reads evicted convos back via
+# _read_convo_messages while holding the lock.
+_storage_lock = threading.RLock()
+
+def _parse_record(line: bytes, offset: int):
+    """Parse one JSONL line; returns None for blank or corrupt lines.
+
+    A crash mid-append leaves a torn final line — losing that one record
+    must not discard the rest of the history.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        rec = _loads(line)
+        if rec.get("convo_id") is not None:
+            return rec
+    except Exception:
+        pass
+    print(f"Skipping unparseable record at offset {offset}")
+    return None
+
 def load_conversations() -> List[Conversation]:
+    _convo_index.clear()
+    convos = {}
     if not os.path.exists(DATA_FILE):
-        return []
+        return _load_legacy()
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            convos = []
-            for c in data:
-                convos.append(
-                    Conversation(
-                        id=c.get("id"),
-                        title=c.get("title"),
-                        messages=[Message(**m) for m in c.get("messages", [])]
+        offset = 0
+        with open(DATA_FILE, "rb") as f:
+            for line in f:
+                rec = _parse_record(line, offset)
+                offset += len(line)
+                if rec is None:
+                    continue
+                convo_id = rec["convo_id"]
+                entry = _convo_index.get(convo_id)
+                if entry is None:
+                    entry = _convo_index[convo_id] = {"offset": offset - len(line), "count": 0}
+                    convos[convo_id] = Conversation(
+                        id=convo_id, title=rec.get("title") or "New Chat", messages=[]
                     )
-                )
-            return convos
+                if rec.get("role") is not None:
+                    entry["count"] += 1
+                elif rec.get("title"):
+                    convos[convo_id].title = rec["title"]
     except Exception as e:
         print(f"Error loading conversations: {e}")
+    return list(convos.values())
+
+def _read_convo_messages(convo_id: str) -> List[Message]:
+    if not os.path.exists(DATA_FILE):
         return []
+    messages = []
+    M = Message  # local binding; positional construction skips kwargs overhead
+    try:
+        with _storage_lock:
+            entry = _convo_index.get(convo_id)
+            offset = entry["offset"] if entry else 0
+            with open(DATA_FILE, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    rec = _parse_record(line, offset)
+                    offset += len(line)
+                    if rec is None or rec["convo_id"] != convo_id or rec.get("role") is None:
+                        continue
+                    messages.append(M(rec["role"], rec["content"]))
+    except Exception as e:
+        print(f"Error loading conversation {convo_id}: {e}")
+    return messages
+
+
+class ConversationCache:
+    """LRU cache keeping at most `capacity` conversations' messages resident.
+
+    Evicted conversations drop their in-memory messages and are transparently
+    reloaded from the JSONL file on next access. A conversation is only
+    evictable when every message it holds is confirmed on disk, and never
+    while a generation is streaming into it (pin/unpin) — eviction rebinds
+    `messages`/`_api_messages`, which would strand an in-flight turn.
+    """
+
+    def __init__(self, capacity: int = CONVO_CACHE_SIZE):
+        self.capacity = capacity
+        self.pinned_id = None
+        self._lru = OrderedDict()  # convo_id -> Conversation
+
+    def get_or_load(self, convo: Conversation) -> List[Message]:
+        if convo.loaded:
+            if convo.id in self._lru:
+                self._lru.move_to_end(convo.id)
+            else:
+                self._lru[convo.id] = convo
+        else:
+            convo.messages = _read_convo_messages(convo.id)
+            convo.sync_api_messages()
+            convo.loaded = True
+            self._lru[convo.id] = convo
+        self._evict()
+        return convo.messages
+
+    def pin(self, convo_id: str):
+        self.pinned_id = convo_id
+
+    def unpin(self):
+        self.pinned_id = None
+
+    def _evict(self):
+        # Soft cap: unevictable entries are skipped, and the most recent
+        # entry is never a candidate — it's the conversation the current
+        # caller is about to use. Runs under the storage lock so a snapshot
+        # on the debounce timer can't observe a convo mid-eviction (loaded
+        # but with its messages already dropped).
+        with _storage_lock:
+            for cid in list(self._lru)[:-1]:
+                if len(self._lru) <= self.capacity:
+                    break
+                convo = self._lru[cid]
+                entry = _convo_index.get(cid)
+                on_disk = entry is not None and entry["count"] >= len(convo.messages)
+                if cid == self.pinned_id or not on_disk:
+                    continue
+                del self._lru[cid]
+                convo.messages = []
+                convo._api_messages = []
+                convo.loaded = False
+
+convo_cache = ConversationCache()
+response_cache = ResponseCache()
+
+def _load_legacy() -> List[Conversation]:
+    if not os.path.exists(LEGACY_DATA_FILE):
+        return []
+    try:
+        with open(LEGACY_DATA_FILE, "rb") as f:
+            data = _loads(f.read())
+        M = Message
+        convos = [
+            Conversation(
+                id=c.get("id"),
+                title=c.get("title"),
+                messages=[M(m["role"], m["content"]) for m in c.get("messages", [])],
+                loaded=True,
+            )
+            for c in data
+        ]
+        for convo in convos:
+            convo.sync_api_messages()
+        # Migrate immediately: later launches only consult DATA_FILE once it
+        # exists, so the legacy history must land there now. If the snapshot
+        # fails, DATA_FILE stays absent and migration is retried next launch.
+        save_conversations(convos)
+        return convos
+    except Exception as e:
+        print(f"Error loading conversations: {e}")
+        return []
+
+def append_message(convo_id: str, seq: int, msg: Message):
+    try:
+        record = {"convo_id": convo_id, "seq": seq, "role": msg.role, "content": msg.content}
+        with _storage_lock:
+            with open(DATA_FILE, "ab") as f:
+                entry = _convo_index.get(convo_id)
+                if entry is None:
+                    entry = _convo_index[convo_id] = {"offset": f.tell(), "count": 0}
+                f.write(_dumps(record) + b"\n")
+                entry["count"] += 1
+    except Exception as e:
+        print(f"Error appending message: {e}")
+
+# Snapshot dedup: most conversations are untouched between snapshots, so
+# their serialized blocks are cached and reused. Messages are append-only
+# and immutable, which makes (title, message count) a content-exact change
+# signal — the fingerprint hashes it without re-encoding the messages.
+_snapshot_cache = {}  # convo_id -> (fingerprint, serialized block)
+
+def _convo_fingerprint(c: Conversation, count: int) -> bytes:
+    key = f"{c.id}\x00{c.title}\x00{count}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
 
 def save_conversations(convos: List[Conversation]):
+    """Write a full JSONL snapshot in a single call (serialize once, one write)."""
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump([
-                {"id": c.id, "title": c.title, "messages": [asdict(m) for m in c.messages]}
-                for c in convos
-            ], f, ensure_ascii=False, indent=2)
+        with _storage_lock:
+            _save_snapshot(convos)
     except Exception as e:
         print(f"Error saving conversations: {e}")
 
+def _save_snapshot(convos: List[Conversation]):
+    blocks = []
+    offset = 0
+    new_index = {}
+    for c in convos:
+        # For evicted conversations the index count stands in for len(msgs)
+        # so a fingerprint hit reuses the cached block without touching disk.
+        if c.loaded:
+            msgs = c.messages
+            count = len(msgs)
+        else:
+            msgs = None
+            entry = _convo_index.get(c.id)
+            count = entry["count"] if entry else 0
+        fp = _convo_fingerprint(c, count)
+        cached = _snapshot_cache.get(c.id)
+        if cached is not None and cached[0] == fp:
+            block = cached[1]
+        else:
+            if msgs is None:
+                # Only on a miss: pull the evicted convo's messages back
+                # from disk so the snapshot stays complete.
+                msgs = _read_convo_messages(c.id)
+                count = len(msgs)
+                fp = _convo_fingerprint(c, count)
+            lines = [_dumps({"convo_id": c.id, "seq": 0, "title": c.title})]
+            for seq, m in enumerate(msgs, start=1):
+                lines.append(_dumps({"convo_id": c.id, "seq": seq, "role": m.role, "content": m.content}))
+            block = b"\n".join(lines) + b"\n"
+            _snapshot_cache[c.id] = (fp, block)
+        new_index[c.id] = {"offset": offset, "count": count}
+        blocks.append(block)
+        offset += len(block)
+    with open(DATA_FILE, "wb") as f:
+        f.write(b"".join(blocks))
+    _convo_index.clear()
+    _convo_index.update(new_index)
+
+
+# Debounced saving: messages arrive in bursts (user turn + assistant turn),
+# so instead of re-serializing the full history on every message we mark the
+# state dirty and flush at most once per SAVE_DEBOUNCE_SECONDS.
+_save_lock = threading.Lock()
+_dirty_convos: List[Conversation] = None
+_save_timer: threading.Timer = None
+
+def mark_dirty(convos: List[Conversation]):
+    global _dirty_convos, _save_timer
+    with _save_lock:
+        _dirty_convos = convos
+        if _save_timer is None:
+            _save_timer = threading.Timer(SAVE_DEBOUNCE_SECONDS, _flush_dirty)
+            _save_timer.daemon = True
+            _save_timer.start()
+
+def _flush_dirty():
+    global _dirty_convos, _save_timer
+    with _save_lock:
+        convos = _dirty_convos
+        _dirty_convos = None
+        _save_timer = None
+    if convos is not None:
+        save_conversations(convos)
+
+def flush_if_dirty():
+    with _save_lock:
+        timer = _save_timer
+    if timer is not None:
+        timer.cancel()
+    _flush_dirty()
+
+atexit.register(flush_if_dirty)
+
+
+# --- Model list ---
+# Walking g4f's model registry is slow enough to delay the first frame, so
+# it happens on a worker thread after first paint and the result is cached
+# on disk with a TTL so later launches skip the walk entirely.
+def _load_cached_models():
+    try:
+        if time.time() - os.path.getmtime(MODELS_CACHE_FILE) < MODELS_CACHE_TTL:
+            with open(MODELS_CACHE_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+    except OSError:
+        pass
+    except Exception as e:
+        print(f"Error reading model cache: {e}")
+    return None
+
+def _save_cached_models(models):
+    try:
+        os.makedirs(os.path.dirname(MODELS_CACHE_FILE), exist_ok=True)
+        with open(MODELS_CACHE_FILE, "w", encoding="utf-8") as f:
+            f.write(json.dumps(models))
+    except Exception as e:
+        print(f"Error writing model cache: {e}")
+
+def fetch_models() -> List[str]:
+    try:
+        models = sorted(g4f.models._all_models)
+    except Exception as e:
+        print(f"Failed to load g4f models: {e}")
+        return FALLBACK_MODELS
+    _save_cached_models(models)
+    return models
+
+# Dropdown options are immutable per model list; memoize them so hot
+# reloads and list refreshes within a process reuse the same objects.
+_OPTIONS_CACHE = {}  # tuple of model names -> list[ft.dropdown.Option]
+
+def model_options(models: List[str]):
+    key = tuple(models)
+    options = _OPTIONS_CACHE.get(key)
+    if options is None:
+        options = _OPTIONS_CACHE[key] = [ft.dropdown.Option(m) for m in models]
+    return options
+
+
+def context_window(api_messages: List[dict]) -> List[dict]:
+    """Bound the request to the newest MAX_CONTEXT_MESSAGES messages.
+
+    A leading system prompt is always kept even when older turns are
+    trimmed, so request size stays constant as the conversation ages.
+    """
+    if len(api_messages) <= MAX_CONTEXT_MESSAGES:
+        return api_messages
+    window = api_messages[-MAX_CONTEXT_MESSAGES:]
+    if api_messages[0].get("role") == "system":
+        window.insert(0, api_messages[0])
+    return window
+
+
+# --- Response chunk handling ---
+# Streamed chunks arrive as str or provider-specific objects. A per-type
+# handler table replaces the isinstance/hasattr chain in the hot loop:
+# each type is inspected once, then every later chunk costs one dict lookup.
+_CHUNK_HANDLERS = {str: lambda c: c}
+
+def _resolve_chunk_handler(chunk):
+    handler = (lambda c: c.content) if hasattr(chunk, "content") else str
+    _CHUNK_HANDLERS[type(chunk)] = handler
+    return handler
+
+def chunk_text(chunk) -> str:
+    handler = _CHUNK_HANDLERS.get(type(chunk)) or _resolve_chunk_handler(chunk)
+    return handler(chunk)
+
 
 # --- UI helpers ---
-def bubble(text: str, is_user: bool = False) -> ft.Container:
+# Shared bubble style objects: padding/margin/alignment are value-typed in
+# Flet, so one instance can back every bubble instead of allocating fresh
+# ones per message during bulk rebuilds.
+_BUBBLE_PAD = ft.padding.symmetric(12, 10)
+_BUBBLE_MARGIN = ft.margin.only(bottom=10)
+_TEXT_STYLE = ft.TextStyle()
+_USER_BG = ft.Colors.BLUE_700
+_ASSIST_BG = ft.Colors.GREY_900
+_ALIGN_R = ft.alignment.top_right
+_ALIGN_L = ft.alignment.top_left
+
+# Sidebar button styles, shared across every rebuild
+_SELECTED_STYLE = ft.ButtonStyle(color=ft.Colors.WHITE, bgcolor=ft.Colors.BLUE)
+_UNSELECTED_STYLE = ft.ButtonStyle()
+
+def bubble(text: str, is_user: bool = False, selectable: bool = False) -> ft.Container:
+    # selectable is opt-in: each selectable Text carries its own selection
+    # gesture recognizer, which adds up over long histories, so only the
+    # bubble being streamed into asks for it.
     return ft.Container(
-        content=ft.Column([ft.Text(text, selectable=True)], tight=True),
-        padding=ft.padding.symmetric(12, 10),
-        alignment=ft.alignment.top_right if is_user else ft.alignment.top_left,
-        bgcolor=ft.Colors.BLUE_700 if is_user else ft.Colors.GREY_900,
+        content=ft.Column([ft.Text(text, style=_TEXT_STYLE, selectable=selectable)], tight=True),
+        padding=_BUBBLE_PAD,
+        alignment=_ALIGN_R if is_user else _ALIGN_L,
+        bgcolor=_USER_BG if is_user else _ASSIST_BG,
         border_radius=12,
-        margin=ft.margin.only(bottom=10),
+        margin=_BUBBLE_MARGIN,
         width=520 if is_user else None,
     )
 
@@ -78,63 +451,152 @@ def main(page: ft.Page):
 
     conversations: List[Conversation] = load_conversations()
     if not conversations:
-        conversations.append(Conversation(id=str(uuid.uuid4()), title="New Chat", messages=[]))
+        conversations.append(Conversation(id=str(uuid.uuid4()), title="New Chat", messages=[], loaded=True))
     selected_index = 0
 
     convo_list = ft.ListView(expand=True, spacing=6, padding=6)
     messages_view = ft.ListView(expand=True, spacing=12, padding=12, auto_scroll=True)
-    input_field = ft.TextField(expand=True, multiline=True, min_lines=1, max_lines=6, hint_text="Type a message...")
+    # shift_enter: Enter submits (on_submit), Shift+Enter inserts a newline —
+    # no global keyboard hook needed, so typing costs no extra event handling.
+    input_field = ft.TextField(expand=True, multiline=True, min_lines=1, max_lines=6, shift_enter=True, hint_text="Type a message...")
     send_button = ft.IconButton(icon=ft.Icons.SEND_ROUNDED)
     title_text = ft.Text("Chat — Flet + g4f", style=ft.TextStyle(size=20, weight="bold"))
 
-    # Dynamically get available models from g4f to avoid invalid names
-    try:
-        available_models = sorted(list(g4f.models._all_models))
-    except Exception as e:
-        print(f"Failed to load g4f models: {e}")
-        available_models = ["gpt-4o-mini", "gpt-3.5-turbo", "gpt-4", "gemini-pro", "claude-3-haiku"]
+    # Start with the cached model list (or just the default) so the first
+    # frame doesn't wait on g4f; a fresh list fills in from a worker thread.
+    cached_models = _load_cached_models()
+    available_models = cached_models or [DEFAULT_MODEL]
 
     model_dropdown = ft.Dropdown(
         width=220,
         value=DEFAULT_MODEL,
-        options=[ft.dropdown.Option(model) for model in available_models],
+        options=model_options(available_models),
         on_change=None  # will be set later
     )
 
+    def _populate_models():
+        models = fetch_models()
+        if models != available_models:
+            model_dropdown.options = model_options(models)
+            page.update()
+
     dark_toggle = ft.Switch(label="Dark mode", value=True)
     streaming_toggle = ft.Switch(label="Stream responses", value=True)
 
+    # Batch UI updates: rebuild helpers call ui_update(), which is a no-op
+    # inside a `with batch_ui():` block so a compound operation (e.g. convo
+    # switch) costs one page round-trip instead of one per rebuild. Blocks
+    # nest; only the outermost exit flushes.
+    suppress_depth = 0
+
+    def ui_update():
+        if suppress_depth == 0:
+            page.update()
+
+    @contextmanager
+    def batch_ui():
+        nonlocal suppress_depth
+        suppress_depth += 1
+        try:
+            yield
+        finally:
+            suppress_depth -= 1
+            if suppress_depth == 0:
+                page.update()
+
+    # One shared handler for every sidebar button: the target index rides on
+    # control.data, so rebuilds stop allocating a closure per conversation.
+    def on_convo_click(e):
+        select_convo(e.control.data)
+
+    # Sidebar buttons are kept aligned with `conversations` and diff-updated:
+    # selection changes restyle two buttons, a new chat appends one, a title
+    # edit touches one — the full rebuild only runs at startup.
+    convo_buttons: List[ft.ElevatedButton] = []
+
+    def _make_convo_button(i: int, c: Conversation) -> ft.ElevatedButton:
+        return ft.ElevatedButton(
+            c.title,
+            width=260,
+            data=i,
+            on_click=on_convo_click,
+            style=_SELECTED_STYLE if i == selected_index else _UNSELECTED_STYLE,
+        )
+
     def rebuild_convo_list():
+        convo_buttons.clear()
         convo_list.controls.clear()
         for i, c in enumerate(conversations):
-            btn = ft.ElevatedButton(
-                c.title,
-                width=260,
-                on_click=lambda e, idx=i: select_convo(idx),
-                style=ft.ButtonStyle(
-                    color=ft.Colors.WHITE if i == selected_index else None,
-                    bgcolor=ft.Colors.BLUE if i == selected_index else None
-                )
-            )
+            btn = _make_convo_button(i, c)
+            convo_buttons.append(btn)
             convo_list.controls.append(btn)
-        page.update()
+        ui_update()
+
+    # Only a window of the newest messages is materialized as bubbles; the
+    # window extends upward when the user scrolls to the top. Constructed
+    # bubbles are kept alive per (convo, index) so re-entering the window
+    # (or re-selecting a conversation) reuses the same controls.
+    bubble_cache = {}  # (convo_id, msg_index) -> ft.Container
+    visible_start = 0
+
+    def _bubble_for(convo: Conversation, idx: int, m: Message) -> ft.Container:
+        key = (convo.id, idx)
+        b = bubble_cache.get(key)
+        if b is None:
+            b = bubble_cache[key] = bubble(m.content, m.role == "user")
+            b.key = f"msg-{convo.id}-{idx}"  # scroll_to anchor for window loads
+        return b
 
     def rebuild_messages():
+        nonlocal visible_start
         messages_view.controls.clear()
         convo = conversations[selected_index]
-        for m in convo.messages:
-            is_user = m.role == "user"
-            messages_view.controls.append(bubble(m.content, is_user))
+        msgs = convo_cache.get_or_load(convo)
+        visible_start = max(0, len(msgs) - VISIBLE_MESSAGES)
+        for i in range(visible_start, len(msgs)):
+            messages_view.controls.append(_bubble_for(convo, i, msgs[i]))
+        ui_update()
+
+    def on_messages_scroll(e: ft.OnScrollEvent):
+        nonlocal visible_start
+        if e.pixels > e.min_scroll_extent or visible_start == 0:
+            return
+        convo = conversations[selected_index]
+        msgs = convo_cache.get_or_load(convo)
+        new_start = max(0, visible_start - VISIBLE_MESSAGES)
+        anchor_key = f"msg-{convo.id}-{visible_start}"
+        # auto_scroll would snap to the newest message as soon as the
+        # children change; suspend it for the prepend, restore the viewport
+        # to the previously-topmost bubble, then re-enable following.
+        messages_view.auto_scroll = False
+        messages_view.controls[:0] = [
+            _bubble_for(convo, i, msgs[i]) for i in range(new_start, visible_start)
+        ]
+        visible_start = new_start
         page.update()
+        messages_view.scroll_to(key=anchor_key, duration=0)
+        messages_view.auto_scroll = True
+
+    messages_view.on_scroll = on_messages_scroll
 
     def select_convo(idx: int):
         nonlocal selected_index
+        old_idx = selected_index
         selected_index = idx
-        rebuild_convo_list()
-        rebuild_messages()
+        with batch_ui():
+            if old_idx != idx and old_idx < len(convo_buttons):
+                convo_buttons[old_idx].style = _UNSELECTED_STYLE
+            if idx < len(convo_buttons):
+                convo_buttons[idx].style = _SELECTED_STYLE
+            rebuild_messages()
 
     def extract_response_content(response):
-        """Extract text content from g4f response which can be various types"""
+        """Extract text content from g4f response which can be various types.
+
+        Returns None when the response cannot be parsed, so callers can
+        treat the generation as failed instead of mistaking the error for
+        a real answer (and, worse, caching it).
+        """
         try:
             if isinstance(response, str):
                 return response
@@ -142,98 +604,151 @@ def main(page: ft.Page):
                 return str(response.content)
             elif hasattr(response, "__iter__"):
                 # Handle non-streaming iterable response
-                chunks = []
-                for chunk in response:
-                    if isinstance(chunk, str):
-                        chunks.append(chunk)
-                    elif hasattr(chunk, "content"):
-                        chunks.append(chunk.content)
-                    else:
-                        chunks.append(str(chunk))
-                return "".join(chunks)
+                return "".join(chunk_text(chunk) for chunk in response)
             else:
                 return str(response)
         except Exception:
-            return "[Error: Could not parse response]"
+            return None
+
+    # Runs on a worker thread (page.run_thread) so network I/O and the chunk
+    # loop never block the UI thread; page.update() calls are marshalled back
+    # by Flet and already coalesced to STREAM_FLUSH_INTERVAL.
+    generating = False
 
     def stream_response(prompt: str):
+        # Wrapper so the busy flag and cache pin are released no matter where
+        # the turn fails — even before the generation try-block is entered
+        # (e.g. a page.update() after a disconnect).
+        nonlocal generating
+        try:
+            _stream_response(prompt)
+        finally:
+            convo_cache.unpin()
+            generating = False
+
+    def _stream_response(prompt: str):
         conv = conversations[selected_index]
-        conv.messages.append(Message(role="user", content=prompt))
-        save_conversations(conversations)
-        rebuild_messages()
+        convo_cache.get_or_load(conv)
+        convo_cache.pin(conv.id)
+        user_msg = Message(role="user", content=prompt)
+        conv.messages.append(user_msg)
+        conv._api_messages.append({"role": "user", "content": prompt})
+        append_message(conv.id, len(conv.messages), user_msg)
+        # Append just the new bubble; rebuilding every prior bubble here
+        # would cost O(history) per turn. Full rebuilds only happen on
+        # conversation switch.
+        messages_view.controls.append(_bubble_for(conv, len(conv.messages) - 1, user_msg))
 
         assistant_msg_content = ""
-        assistant_bubble = bubble(assistant_msg_content, False)
+        assistant_bubble = bubble(assistant_msg_content, False, selectable=True)
         messages_view.controls.append(assistant_bubble)
         page.update()
 
         try:
             model = model_dropdown.value or DEFAULT_MODEL
 
+            api_messages = context_window(conv._api_messages)
+
+            # Exact repeat of a known conversation state: replay the cached
+            # response and skip the network entirely.
+            prompt_hash = ResponseCache.messages_hash(api_messages)
+            cached = response_cache.get(model, prompt_hash)
+            if cached is not None:
+                assistant_msg_content = cached
+                assistant_bubble.content.controls[0].value = assistant_msg_content
+                page.update()
             # Try streaming if enabled
-            if streaming_toggle.value:
+            elif streaming_toggle.value:
                 try:
                     response = g4f.ChatCompletion.create(
                         model=model,
-                        messages=[{"role": m.role, "content": m.content} for m in conv.messages],
+                        messages=api_messages,
                         stream=True,
                     )
+                    # Accumulate chunks in a list and only push to the UI at a
+                    # bounded cadence: joining once per flush avoids quadratic
+                    # string rebuilds and one page round-trip per token.
+                    parts = []
+                    last_flush = time.monotonic()
                     for chunk in response:
-                        if isinstance(chunk, str):
-                            assistant_msg_content += chunk
-                        elif hasattr(chunk, "content"):
-                            assistant_msg_content += chunk.content
-                        else:
-                            assistant_msg_content += str(chunk)
-                        assistant_bubble.content.controls[0].value = assistant_msg_content
-                        page.update()
+                        parts.append(chunk_text(chunk))
+                        now = time.monotonic()
+                        if now - last_flush > STREAM_FLUSH_INTERVAL:
+                            assistant_bubble.content.controls[0].value = "".join(parts)
+                            page.update()
+                            last_flush = now
+                    assistant_msg_content = "".join(parts)
+                    assistant_bubble.content.controls[0].value = assistant_msg_content
+                    page.update()
                 except Exception as e:
                     print(f"Streaming failed for {model}: {e}")
-                    # Fallback to non-streaming
+                    # Fallback to non-streaming; reuses the same payload
                     response = g4f.ChatCompletion.create(
                         model=model,
-                        messages=[{"role": m.role, "content": m.content} for m in conv.messages],
+                        messages=api_messages,
                         stream=False,
                     )
-                    assistant_msg_content = extract_response_content(response)
+                    content = extract_response_content(response)
+                    if content is None:
+                        raise ValueError("could not parse provider response")
+                    assistant_msg_content = content
                     assistant_bubble.content.controls[0].value = assistant_msg_content
                     page.update()
             else:
                 # Non-streaming mode
                 response = g4f.ChatCompletion.create(
                     model=model,
-                    messages=[{"role": m.role, "content": m.content} for m in conv.messages],
+                    messages=api_messages,
                     stream=False,
                 )
-                assistant_msg_content = extract_response_content(response)
+                content = extract_response_content(response)
+                if content is None:
+                    raise ValueError("could not parse provider response")
+                assistant_msg_content = content
                 assistant_bubble.content.controls[0].value = assistant_msg_content
                 page.update()
 
+            # Only generations that completed without error reach this point,
+            # so failures are never persisted and replayed as answers.
+            if cached is None and assistant_msg_content:
+                response_cache.put(model, prompt_hash, assistant_msg_content)
+
             # Save final assistant message
-            conv.messages.append(Message(role="assistant", content=assistant_msg_content))
-            save_conversations(conversations)
+            assistant_msg = Message(role="assistant", content=assistant_msg_content)
+            conv.messages.append(assistant_msg)
+            conv._api_messages.append({"role": "assistant", "content": assistant_msg_content})
+            assistant_bubble.key = f"msg-{conv.id}-{len(conv.messages) - 1}"
+            bubble_cache[(conv.id, len(conv.messages) - 1)] = assistant_bubble
+            append_message(conv.id, len(conv.messages), assistant_msg)
 
         except Exception as e:
             error_text = f"[Error: Cannot get response from '{model}'. {str(e)}]"
             assistant_msg_content += error_text
             assistant_bubble.content.controls[0].value = assistant_msg_content
-            conv.messages.append(Message(role="assistant", content=assistant_msg_content))
-            save_conversations(conversations)
+            error_msg = Message(role="assistant", content=assistant_msg_content)
+            conv.messages.append(error_msg)
+            conv._api_messages.append({"role": "assistant", "content": assistant_msg_content})
+            assistant_bubble.key = f"msg-{conv.id}-{len(conv.messages) - 1}"
+            bubble_cache[(conv.id, len(conv.messages) - 1)] = assistant_bubble
+            append_message(conv.id, len(conv.messages), error_msg)
             page.update()
 
     def on_send_click(e=None):
+        nonlocal generating
         text = input_field.value.strip()
-        if not text:
+        if not text or generating:
             return
 
         # Update title if first message
         if not conversations[selected_index].messages:
             conversations[selected_index].title = text[:30] + "..." if len(text) > 30 else text
-            rebuild_convo_list()
+            mark_dirty(conversations)
+            convo_buttons[selected_index].text = conversations[selected_index].title
 
         input_field.value = ""
         page.update()
-        stream_response(text)
+        generating = True
+        page.run_thread(stream_response, text)
 
     send_button.on_click = on_send_click
     input_field.on_submit = on_send_click
@@ -257,10 +772,13 @@ def main(page: ft.Page):
 
     def new_chat():
         new_id = str(uuid.uuid4())
-        conversations.append(Conversation(id=new_id, title=f"Chat {len(conversations)+1}", messages=[]))
-        save_conversations(conversations)
-        rebuild_convo_list()
-        select_convo(len(conversations) - 1)
+        conversations.append(Conversation(id=new_id, title=f"Chat {len(conversations)+1}", messages=[], loaded=True))
+        mark_dirty(conversations)
+        with batch_ui():
+            btn = _make_convo_button(len(conversations) - 1, conversations[-1])
+            convo_buttons.append(btn)
+            convo_list.controls.append(btn)
+            select_convo(len(conversations) - 1)
 
     def on_dark(e):
         page.theme_mode = ft.ThemeMode.DARK if dark_toggle.value else ft.ThemeMode.LIGHT
@@ -268,11 +786,8 @@ def main(page: ft.Page):
 
     dark_toggle.on_change = on_dark
 
-    # Keyboard shortcut: Enter to send, Shift+Enter for new line
-    def on_key(e: ft.KeyboardEvent):
-        if e.key == "Enter" and not e.shift and input_field.focused:
-            on_send_click()
-    page.on_keyboard_event = on_key
+    # Guarantee the last burst of messages hits disk when the window closes.
+    page.on_disconnect = lambda e: flush_if_dirty()
 
     # Rebuild UI
     rebuild_convo_list()
@@ -281,6 +796,10 @@ def main(page: ft.Page):
     # Add main layout
     page.add(ft.Row([left_col, ft.VerticalDivider(width=1), right_col], expand=True))
 
+    # Refresh the model list off the startup path once the UI is visible
+    if cached_models is None:
+        page.run_thread(_populate_models)
+
 
 if __name__ == "__main__":
     ft.app(target=main, view=ft.AppView.FLET_APP)
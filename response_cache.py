@@ -0,0 +1,62 @@
+# --- Response cache ---
+# Exact-match cache for g4f completions, keyed by model plus a blake2b
+# digest of the message payload. Repeating the same conversation state
+# returns the stored response in milliseconds instead of a network
+# round-trip. Backed by SQLite so hits survive restarts.
+import hashlib
+import json
+import sqlite3
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CACHE_FILE = "response_cache.db"
+
+
+class ResponseCache:
+    def __init__(self, path: str = CACHE_FILE):
+        # check_same_thread=False: generation runs on worker threads
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " model TEXT NOT NULL,"
+            " messages_hash BLOB NOT NULL,"
+            " response TEXT NOT NULL,"
+            " PRIMARY KEY (model, messages_hash))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def messages_hash(messages) -> bytes:
+        if orjson is not None:
+            payload = orjson.dumps(messages)
+        else:
+            payload = json.dumps(messages, ensure_ascii=False).encode("utf-8")
+        return hashlib.blake2b(payload, digest_size=16).digest()
+
+    def get(self, model: str, messages_hash: bytes):
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT response FROM responses WHERE model = ? AND messages_hash = ?",
+                    (model, messages_hash),
+                ).fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            print(f"Error reading response cache: {e}")
+            return None
+
+    def put(self, model: str, messages_hash: bytes, response: str):
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                    (model, messages_hash, response),
+                )
+                self._conn.commit()
+        except Exception as e:
+            print(f"Error writing response cache: {e}")